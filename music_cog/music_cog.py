@@ -1,479 +1,778 @@
-import discord
-from discord.ext import commands
-
-import asyncio
-import itertools
-import sys
-import traceback
-from async_timeout import timeout
-from functools import partial
-from youtube_dl import YoutubeDL
-
-ytdlopts = {
-    'format': 'bestaudio/best',
-    'outtmpl': 'downloads/%(extractor)s-%(id)s-%(title)s.%(ext)s',
-    'restrictfilenames': True,
-    'noplaylist': True,
-    'nocheckcertificate': True,
-    'ignoreerrors': False,
-    'logtostderr': False,
-    'quiet': True,
-    'no_warnings': True,
-    'default_search': 'auto',
-    'source_address': '0.0.0.0'  # ipv6 addresses cause issues sometimes
-}
-
-ffmpegopts = {
-    'before_options': '-nostdin',
-    'options': '-vn'
-}
-
-ytdl = YoutubeDL(ytdlopts)
-
-
-class VoiceConnectionError(commands.CommandError):
-    """Custom Exception class for connection errors."""
-
-
-class InvalidVoiceChannel(VoiceConnectionError):
-    """Exception for cases of invalid Voice Channels."""
-
-
-class YTDLSource(discord.PCMVolumeTransformer):
-
-    def __init__(self, source, *, data, requester):
-        super().__init__(source)
-        self.requester = requester
-
-        self.title = data.get('title')
-        self.web_url = data.get('webpage_url')
-
-        # YTDL info dicts (data) have other useful information you might want
-        # https://github.com/rg3/youtube-dl/blob/master/README.md
-
-    def __getitem__(self, item: str):
-        """Allows us to access attributes similar to a dict.
-        This is only useful when you are NOT downloading.
-        """
-        return self.__getattribute__(item)
-
-    @classmethod
-    async def create_source(cls, ctx, search: str, *, loop, download=False):
-        loop = loop or asyncio.get_event_loop()
-
-        to_run = partial(ytdl.extract_info, url=search, download=download)
-        data = await loop.run_in_executor(None, to_run)
-
-        if 'entries' in data:
-            # take first item from a playlist
-            data = data['entries'][0]
-
-        embed = discord.Embed(color=0x001eff)
-        embed.add_field(name="Message:", value=f'```ini\n[Added {data["title"]} to the Queue.]\n```', inline=True)
-        embed.set_footer(text="Bot by stunning_munda#2359")
-        await ctx.send(embed=embed)
-
-        if download:
-            source = ytdl.prepare_filename(data)
-        else:
-            return {'webpage_url': data['webpage_url'], 'requester': ctx.author, 'title': data['title']}
-
-        return cls(discord.FFmpegPCMAudio(source), data=data, requester=ctx.author)
-
-    @classmethod
-    async def regather_stream(cls, data, *, loop):
-        """Used for preparing a stream, instead of downloading.
-        Since Youtube Streaming links expire."""
-        loop = loop or asyncio.get_event_loop()
-        requester = data['requester']
-
-        to_run = partial(ytdl.extract_info, url=data['webpage_url'], download=False)
-        data = await loop.run_in_executor(None, to_run)
-
-        return cls(discord.FFmpegPCMAudio(data['url']), data=data, requester=requester)
-
-
-class MusicPlayer(commands.Cog):
-    """A class which is assigned to each guild using the bot for Music.
-    This class implements a queue and loop, which allows for different guilds to listen to different playlists
-    simultaneously.
-    When the bot disconnects from the Voice it's instance will be destroyed.
-    """
-
-    __slots__ = ('bot', '_guild', '_channel', '_cog', 'queue', 'next', 'current', 'np', 'volume')
-
-    def __init__(self, ctx):
-        self.bot = ctx.bot
-        self._guild = ctx.guild
-        self._channel = ctx.channel
-        self._cog = ctx.cog
-
-        self.queue = asyncio.Queue()
-        self.next = asyncio.Event()
-
-        self.np = None  # Now playing message
-        self.volume = .5
-        self.current = None
-
-        ctx.bot.loop.create_task(self.player_loop())
-
-    async def player_loop(self):
-        """Our main player loop."""
-        await self.bot.wait_until_ready()
-
-        while not self.bot.is_closed():
-            self.next.clear()
-
-            try:
-                # Wait for the next song. If we timeout cancel the player and disconnect...
-                async with timeout(300):  # 5 minutes...
-                    source = await self.queue.get()
-            except asyncio.TimeoutError:
-                return self.destroy(self._guild)
-
-            if not isinstance(source, YTDLSource):
-                # Source was probably a stream (not downloaded)
-                # So we should regather to prevent stream expiration
-                try:
-                    source = await YTDLSource.regather_stream(source, loop=self.bot.loop)
-                except Exception as e:
-                    embed = discord.Embed(color=0x001eff)
-                    embed.add_field(name="Message:",
-                                    value='Please make sure you are in a valid channel or provide me with one!',
-                                    inline=True)
-                    embed.set_footer(text="Bot by stunning_munda#2359")
-                    await self._channel.send(embed=embed)
-                    continue
-
-            source.volume = self.volume
-            self.current = source
-
-            self._guild.voice_client.play(source, after=lambda _: self.bot.loop.call_soon_threadsafe(self.next.set))
-            np_embed = discord.Embed(color=0x001eff)
-            np_embed.add_field(name="Message:",
-                               value=f'**Now Playing:** `{source.title}` requested by 'f'`{source.requester}`',
-                               inline=True)
-            np_embed.set_footer(text="Bot by stunning_munda#2359")
-            self.np = await self._channel.send(embed=np_embed)
-            await self.next.wait()
-
-            # Make sure the FFmpeg process is cleaned up.
-            source.cleanup()
-            self.current = None
-
-            try:
-                # We are no longer playing this song...
-                await self.np.delete()
-            except discord.HTTPException:
-                pass
-
-    def destroy(self, guild):
-        """Disconnect and cleanup the player."""
-        return self.bot.loop.create_task(self._cog.cleanup(guild))
-
-
-class Music(commands.Cog):
-    """Music related commands."""
-
-    __slots__ = ('bot', 'players')
-
-    def __init__(self, bot):
-        self.bot = bot
-        self.players = {}
-
-    async def cleanup(self, guild):
-        try:
-            await guild.voice_client.disconnect()
-        except AttributeError:
-            pass
-
-        try:
-            del self.players[guild.id]
-        except KeyError:
-            pass
-
-    async def __local_check(self, ctx):
-        """A local check which applies to all commands in this cog."""
-        if not ctx.guild:
-            raise commands.NoPrivateMessage
-        return True
-
-    async def __error(self, ctx, error):
-        """A local error handler for all errors arising from commands in this cog."""
-        if isinstance(error, commands.NoPrivateMessage):
-            try:
-                return await ctx.send('This command can not be used in Private Messages.')
-            except discord.HTTPException:
-                pass
-        elif isinstance(error, InvalidVoiceChannel):
-            embed = discord.Embed(color=0x001eff)
-            embed.add_field(name="Message:", value='Please make sure you are in a valid channel or provide me with one',
-                            inline=True)
-            embed.set_footer(text="Bot by stunning_munda#2359")
-            return await ctx.send(embed=embed)
-
-        print('Ignoring exception in command {}:'.format(ctx.command), file=sys.stderr)
-        traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
-
-    def get_player(self, ctx):
-        """Retrieve the guild player, or generate one."""
-        try:
-            player = self.players[ctx.guild.id]
-        except KeyError:
-            player = MusicPlayer(ctx)
-            self.players[ctx.guild.id] = player
-
-        return player
-
-    @commands.command(name='connect', aliases=['join'])
-    async def connect_(self, ctx):
-        try:
-            channel = ctx.author.voice.channel
-        except AttributeError:
-            embed = discord.Embed(color=0x001eff)
-            embed.add_field(name="Message:", value='No channel to join.', inline=True)
-            embed.set_footer(text="Bot by stunning_munda#2359")
-            await ctx.send(embed=embed)
-            raise InvalidVoiceChannel('No channel to join.')
-
-        vc = ctx.voice_client
-
-        if vc:
-            if vc.channel.id == channel.id:
-                return
-            try:
-                await vc.move_to(channel)
-            except asyncio.TimeoutError:
-                embed = discord.Embed(color=0x001eff)
-                embed.add_field(name="Message:", value=f'Moving to channel: <{channel}> timed out.', inline=True)
-                embed.set_footer(text="Bot by stunning_munda#2359")
-                await ctx.send(embed=embed)
-                raise VoiceConnectionError(f'Moving to channel: <{channel}> timed out.')
-        else:
-            try:
-                await channel.connect()
-            except asyncio.TimeoutError:
-                embed = discord.Embed(color=0x001eff)
-                embed.add_field(name="Message:", value=f'Connecting to channel: <{channel}> timed out.', inline=True)
-                embed.set_footer(text="Bot by stunning_munda#2359")
-                await ctx.send(embed=embed)
-                raise VoiceConnectionError(f'Connecting to channel: <{channel}> timed out.')
-
-        embed = discord.Embed(color=0x001eff)
-        embed.add_field(name="Message:", value=f':white_check_mark: Connected to: **{channel}** :white_check_mark:',
-                        inline=True)
-        embed.set_footer(text="Bot by stunning_munda#2359")
-        await ctx.send(embed=embed)
-
-    @commands.command(name='play', aliases=['sing'])
-    async def play_(self, ctx, *, search: str):
-        await ctx.trigger_typing()
-
-        vc = ctx.voice_client
-
-        if not vc:
-            await ctx.invoke(self.connect_)
-
-        player = self.get_player(ctx)
-
-        # If download is False, source will be a dict which will be used later to regather the stream.
-        # If download is True, source will be a discord.FFmpegPCMAudio with a VolumeTransformer.
-        source = await YTDLSource.create_source(ctx, search, loop=self.bot.loop, download=False)
-
-        await player.queue.put(source)
-
-    @commands.command(name='pause')
-    async def pause_(self, ctx):
-        """Pause the currently playing song."""
-        vc = ctx.voice_client
-
-        if not vc or not vc.is_playing():
-            embed = discord.Embed(color=0x001eff)
-            embed.add_field(name="Message:", value='I am not currently playing anything!', inline=True)
-            embed.set_footer(text="Bot by stunning_munda#2359")
-            return await ctx.send(embed=embed)
-        elif vc.is_paused():
-            return
-
-        vc.pause()
-        embed = discord.Embed(color=0x001eff)
-        embed.add_field(name="Message:", value=f'**`{ctx.author}`**: Paused the song!', inline=True)
-        embed.set_footer(text="Bot by stunning_munda#2359")
-        await ctx.send(embed=embed)
-
-    @commands.command(name='resume')
-    async def resume_(self, ctx):
-        """Resume the currently paused song."""
-        vc = ctx.voice_client
-
-        if not vc or not vc.is_connected():
-            embed = discord.Embed(color=0x001eff)
-            embed.add_field(name="Message:", value='I am not currently playing anything!', inline=True)
-            embed.set_footer(text="Bot by stunning_munda#2359")
-            return await ctx.send(embed=embed)
-        elif not vc.is_paused():
-            return
-
-        vc.resume()
-        embed = discord.Embed(color=0x001eff)
-        embed.add_field(name="Message:", value=f'**`{ctx.author}`**: Resumed the song!', inline=True)
-        embed.set_footer(text="Bot by stunning_munda#2359")
-        await ctx.send(embed=embed)
-
-    @commands.command(name='skip')
-    async def skip_(self, ctx):
-        """Skip the song."""
-        vc = ctx.voice_client
-
-        if not vc or not vc.is_connected():
-            embed = discord.Embed(color=0x001eff)
-            embed.add_field(name="Message:", value='I am not currently playing anything!', inline=True)
-            embed.set_footer(text="Bot by stunning_munda#2359")
-            return await ctx.send(embed=embed)
-
-        if vc.is_paused():
-            pass
-        elif not vc.is_playing():
-            return
-
-        vc.stop()
-        embed = discord.Embed(color=0x001eff)
-        embed.add_field(name="Message:", value=f'**`{ctx.author}`**: Skipped the song!', inline=True)
-        embed.set_footer(text="Bot by stunning_munda#2359")
-        await ctx.send(embed=embed)
-
-    @commands.command(name='queue', aliases=['q', 'playlist'])
-    async def queue_info(self, ctx):
-        """Retrieve a basic queue of upcoming songs."""
-        vc = ctx.voice_client
-
-        if not vc or not vc.is_connected():
-            embed = discord.Embed(color=0x001eff)
-            embed.add_field(name="Message:", value='I am not currently connected to voice!', inline=True)
-            embed.set_footer(text="Bot by stunning_munda#2359")
-            return await ctx.send(embed=embed)
-
-        player = self.get_player(ctx)
-        if player.queue.empty():
-            embed = discord.Embed(color=0x001eff)
-            embed.add_field(name="Message:", value='There are currently no more queued songs.', inline=True)
-            embed.set_footer(text="Bot by stunning_munda#2359")
-            return await ctx.send(embed=embed)
-
-        # Grab up to 5 entries from the queue...
-        upcoming = list(itertools.islice(player.queue._queue, 0, 5))
-
-        fmt = '\n'.join(f'**`{_["title"]}`**' for _ in upcoming)
-        embed = discord.Embed(title=f'Upcoming - Next {len(upcoming)}', description=fmt)
-
-        await ctx.send(embed=embed)
-
-    @commands.command(name='now_playing', aliases=['np', 'current', 'currentsong', 'playing'])
-    async def now_playing_(self, ctx):
-        """Display information about the currently playing song."""
-        vc = ctx.voice_client
-
-        if not vc or not vc.is_connected():
-            embed = discord.Embed(color=0x001eff)
-            embed.add_field(name="Message:", value='I am not currently connected to voice!', inline=True)
-            embed.set_footer(text="Bot by stunning_munda#2359")
-            return await ctx.send(embed=embed)
-
-        player = self.get_player(ctx)
-        if not player.current:
-            embed = discord.Embed(color=0x001eff)
-            embed.add_field(name="Message:", value='I am not currently playing anything!', inline=True)
-            embed.set_footer(text="Bot by stunning_munda#2359")
-            return await ctx.send(embed=embed)
-
-        try:
-            # Remove our previous now_playing message.
-            await player.np.delete()
-        except discord.HTTPException:
-            pass
-
-        embed = discord.Embed(color=0x001eff)
-        embed.add_field(name="Message:",
-                        value=f'**Now Playing:** `{vc.source.title}` 'f'requested by `{vc.source.requester}`',
-                        inline=True)
-        embed.set_footer(text="Bot by stunning_munda#2359")
-
-        player.np = await ctx.send(embed=embed)
-
-    @commands.command(name='volume', aliases=['vol'])
-    async def change_volume(self, ctx, *, vol: float):
-        """Change the player volume.
-        Parameters
-        ------------
-        volume: float or int [Required]
-            The volume to set the player to in percentage. This must be between 1 and 100.
-        """
-        vc = ctx.voice_client
-
-        if not vc or not vc.is_connected():
-            embed = discord.Embed(color=0x001eff)
-            embed.add_field(name="Message:", value="I am not currently connected to voice!", inline=True)
-            embed.set_footer(text="Bot by stunning_munda#2359")
-            await ctx.send(embed=embed)
-
-        if not 0 < vol < 101:
-            embed = discord.Embed(color=0x001eff)
-            embed.add_field(name="Message:", value="Please enter a value between 1 and 100.", inline=True)
-            embed.set_footer(text="Bot by stunning_munda#2359")
-            await ctx.send(embed=embed)
-
-        player = self.get_player(ctx)
-
-        if vc.source:
-            vc.source.volume = vol / 100
-
-        player.volume = vol / 100
-        embed = discord.Embed(color=0x001eff)
-        embed.add_field(name="Message:", value=f'**`{ctx.author}`**: Set the volume to **{vol}%**', inline=True)
-        embed.set_footer(text="Bot by stunning_munda#2359")
-        await ctx.send(embed=embed)
-        await ctx.send()
-
-    @commands.command(name='stop', aliases=['leave'])
-    async def stop_(self, ctx):
-        """Stop the currently playing song and destroy the player.
-        !Warning!
-            This will destroy the player assigned to your guild, also deleting any queued songs and settings.
-        """
-        vc = ctx.voice_client
-
-        if not vc or not vc.is_connected():
-            embed = discord.Embed(color=0x001eff)
-            embed.add_field(name="Message:", value="I am not currently playing anything!", inline=True)
-            embed.set_footer(text="Bot by stunning_munda#2359")
-            return await ctx.send(embed=embed)
-
-        await self.cleanup(ctx.guild)
-
-    @commands.command()
-    async def server_info(self, ctx):
-        name = str(ctx.guild.name)
-        description = str(ctx.guild.description)
-
-        owner = str(ctx.guild.owner)
-        id = str(ctx.guild.id)
-        region = str(ctx.guild.region)
-        memberCount = str(ctx.guild.member_count)
-
-        icon = str(ctx.guild.icon_url)
-
-        embed = discord.Embed(
-            title=name + " Server Information",
-            description=description,
-            color=discord.Color.blue()
-        )
-        embed.set_thumbnail(url=icon)
-        embed.add_field(name="Owner", value=owner, inline=True)
-        embed.add_field(name="Server ID", value=id, inline=True)
-        embed.add_field(name="Region", value=region, inline=True)
-        embed.add_field(name="Member Count", value=memberCount, inline=True)
-
-        await ctx.send(embed=embed)
-
-def setup(bot):
+import discord
+from discord.ext import commands
+
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import sys
+import threading
+import time
+import traceback
+from async_timeout import timeout
+from functools import lru_cache, partial
+from urllib.parse import parse_qs, urlparse
+from weakref import WeakValueDictionary
+from yt_dlp import YoutubeDL
+
+log = logging.getLogger(__name__)
+
+ytdlopts = {
+    'format': 'bestaudio/best',
+    'outtmpl': 'downloads/%(extractor)s-%(id)s-%(title)s.%(ext)s',
+    'restrictfilenames': True,
+    'noplaylist': True,
+    'nocheckcertificate': True,
+    'ignoreerrors': False,
+    'logtostderr': False,
+    'quiet': True,
+    'no_warnings': True,
+    'default_search': 'auto',
+    'source_address': '0.0.0.0',  # ipv6 addresses cause issues sometimes
+    'extractor_args': {'youtube': {'player_skip': ['webpage']}}  # streaming doesn't need the full page
+}
+
+ffmpegopts = {
+    # -reconnect*: recover from transient HTTP stalls on YouTube's CDN instead of ending the track.
+    # -probesize/-analyzeduration: start decoding after a few frames rather than probing seconds of stream.
+    'before_options': '-nostdin -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+                      ' -probesize 32k -analyzeduration 0',
+    'options': '-vn -bufsize 512k'
+}
+
+# YoutubeDL mutates internal state while extracting, so instead of one shared
+# module-level instance each executor thread lazily gets its own.
+_tls = threading.local()
+
+
+def _get_ytdl():
+    """Return this thread's YoutubeDL instance, creating it on first use."""
+    ytdl = getattr(_tls, 'ytdl', None)
+    if ytdl is None:
+        ytdl = _tls.ytdl = YoutubeDL(ytdlopts)
+    return ytdl
+
+
+_EMBED_COLOR = 0x001eff
+_EMBED_FOOTER = 'Bot by stunning_munda#2359'
+
+
+def _msg(value):
+    """Build the cog's standard single-message reply embed."""
+    return discord.Embed(color=_EMBED_COLOR, description=value).set_footer(text=_EMBED_FOOTER)
+
+
+@lru_cache(maxsize=None)
+def _msg_dict(value):
+    return _msg(value).to_dict()
+
+
+def _static_msg(value):
+    """Like _msg, but for the fixed reply strings: reuses a pre-serialized dict."""
+    return discord.Embed.from_dict(_msg_dict(value))
+
+
+# Cache of extract_info results keyed by (url, download) so queueing and
+# playback don't each pay a full YouTube round-trip for the same track.
+# Accessed from multiple ytdl pool threads, so every read/insert/eviction
+# happens under the lock.
+_EXTRACT_TTL = 3600
+_EXTRACT_CACHE_MAX = 64
+_extract_cache = {}
+_extract_lock = threading.Lock()
+
+
+def _cache_put(key, data):
+    """Store an extraction result, evicting expired and excess entries.
+
+    Info dicts run from ~100 KB to several MB, so the cache is bounded instead
+    of letting every track ever played pin its metadata for the process life.
+    """
+    now = time.monotonic()
+    with _extract_lock:
+        for k in [k for k, (ts, _) in _extract_cache.items() if now - ts >= _EXTRACT_TTL]:
+            del _extract_cache[k]
+        while len(_extract_cache) >= _EXTRACT_CACHE_MAX:
+            oldest = min(_extract_cache, key=lambda k: _extract_cache[k][0])
+            del _extract_cache[oldest]
+        _extract_cache[key] = (now, data)
+
+
+def _extract(url, download, process=True):
+    """Run ytdl.extract_info, reusing a cached result if it is under an hour old."""
+    key = (url, download, process)
+    with _extract_lock:
+        cached = _extract_cache.get(key)
+    if cached is not None and time.monotonic() - cached[0] < _EXTRACT_TTL:
+        return cached[1]
+
+    data = _get_ytdl().extract_info(url=url, download=download, process=process)
+    # Unprocessed playlist/search results carry 'entries' as a one-shot
+    # generator; materialize it so cache hits don't replay a consumed iterator.
+    if isinstance(data, dict) and 'entries' in data and not isinstance(data['entries'], list):
+        data['entries'] = list(data['entries'])
+    _cache_put(key, data)
+    return data
+
+
+def _extract_entry(search, download):
+    """Resolve a search or URL to a single, fully processed info dict.
+
+    Playlist and search URLs are scanned flat first (process=False) so only
+    the entry we actually play pays for signature deciphering and format
+    selection, instead of resolving every video in the playlist.
+    """
+    data = _extract(search, download, process=False)
+    if 'entries' in data:
+        # take first item from a playlist
+        entry = data['entries'][0]
+        return _extract(entry.get('url') or entry['id'], download)
+
+    processed = _get_ytdl().process_ie_result(dict(data), download=download)
+    # Seed the flat cache under the canonical URL too, so regathering can
+    # reuse the page data even when the original search string differed.
+    with _extract_lock:
+        seeded = (processed['webpage_url'], download, False) in _extract_cache
+    if not seeded:
+        _cache_put((processed['webpage_url'], download, False), data)
+    return processed
+
+
+def _regather(url):
+    """Resolve a fresh stream URL for ``url``, preferring cached page data.
+
+    extract_info splits into a network-bound page fetch and the CPU-bound
+    processing phase (signature deciphering, format selection). When the
+    unprocessed page data is still cached, only the processing phase is
+    re-run; a full fetch happens only if that still yields an expired URL.
+    """
+    key = (url, False, False)
+    with _extract_lock:
+        cached = _extract_cache.get(key)
+    if cached is not None and time.monotonic() - cached[0] < _EXTRACT_TTL:
+        info = _get_ytdl().process_ie_result(dict(cached[1]), download=False)
+        if info.get('url') and not _stream_url_expired(info['url']):
+            return info
+        with _extract_lock:
+            _extract_cache.pop(key, None)
+
+    return _get_ytdl().extract_info(url=url, download=False)
+
+
+def _stream_url_expired(url):
+    """Check whether a YouTube stream URL's embedded expire timestamp has passed.
+
+    Treats URLs without an expire parameter as expired so we re-fetch them, and
+    keeps a five minute margin so a track can't outlive its URL mid-playback.
+    """
+    try:
+        expire = int(parse_qs(urlparse(url).query)['expire'][0])
+    except (KeyError, ValueError):
+        return True
+    return expire - time.time() <= 300
+
+
+class VoiceConnectionError(commands.CommandError):
+    """Custom Exception class for connection errors."""
+
+
+class InvalidVoiceChannel(VoiceConnectionError):
+    """Exception for cases of invalid Voice Channels."""
+
+
+class YTDLTimeout(commands.CommandError):
+    """Exception for youtube-dl taking too long to respond."""
+
+
+class YTDLSource(discord.PCMVolumeTransformer):
+
+    def __init__(self, source, *, data, requester):
+        super().__init__(source)
+        self.requester = requester
+
+        self.title = data.get('title')
+        self.web_url = data.get('webpage_url')
+
+        # YTDL info dicts (data) have other useful information you might want
+        # https://github.com/rg3/youtube-dl/blob/master/README.md
+
+    def __getitem__(self, item: str):
+        """Allows us to access attributes similar to a dict.
+        This is only useful when you are NOT downloading.
+        """
+        return self.__getattribute__(item)
+
+    @classmethod
+    async def create_source(cls, ctx, search: str, *, loop, pool=None, download=False):
+        loop = loop or asyncio.get_event_loop()
+
+        to_run = partial(_extract_entry, search, download)
+        try:
+            data = await asyncio.wait_for(loop.run_in_executor(pool, to_run), timeout=30)
+        except asyncio.TimeoutError:
+            raise YTDLTimeout(f'Searching for "{search}" timed out.')
+
+        await ctx.send(embed=_msg(f'```ini\n[Added {data["title"]} to the Queue.]\n```'))
+
+        if download:
+            source = _get_ytdl().prepare_filename(data)
+        else:
+            return {'webpage_url': data['webpage_url'], 'requester': ctx.author, 'title': data['title'],
+                    '_data': data}
+
+        return cls(discord.FFmpegPCMAudio(source), data=data, requester=ctx.author)
+
+    @classmethod
+    async def create_playlist_sources(cls, ctx, search: str, *, loop, pool=None):
+        """Resolve every entry of a playlist URL into queueable source dicts.
+
+        Entries are fully extracted concurrently, at most four at a time, so a
+        playlist queues in roughly one track's latency instead of N of them.
+        Returns (sources, unavailable_count).
+        """
+        loop = loop or asyncio.get_event_loop()
+
+        to_run = partial(_extract, search, False, False)
+        try:
+            data = await asyncio.wait_for(loop.run_in_executor(pool, to_run), timeout=30)
+        except asyncio.TimeoutError:
+            raise YTDLTimeout(f'Searching for "{search}" timed out.')
+
+        entries = list(data['entries']) if 'entries' in data else [data]
+
+        sem = asyncio.Semaphore(4)
+
+        async def resolve(entry):
+            async with sem:
+                run = partial(_extract, entry.get('url') or entry.get('webpage_url') or entry['id'], False)
+                return await asyncio.wait_for(loop.run_in_executor(pool, run), timeout=30)
+
+        # One deleted or private video shouldn't abort the whole playlist:
+        # collect failures and queue whatever did resolve.
+        results = await asyncio.gather(*(resolve(entry) for entry in entries), return_exceptions=True)
+
+        sources = [{'webpage_url': d['webpage_url'], 'requester': ctx.author, 'title': d['title'], '_data': d}
+                   for d in results if not isinstance(d, Exception)]
+        for err in results:
+            if isinstance(err, Exception):
+                log.warning('Skipping playlist entry: %s', err)
+
+        # The caller announces the outcome once it knows how many actually fit
+        # in the queue.
+        return sources, len(results) - len(sources)
+
+    @classmethod
+    async def regather_stream(cls, data, *, loop, pool=None, volume=None):
+        """Used for preparing a stream, instead of downloading.
+        Since Youtube Streaming links expire.
+
+        When the player volume is 1.0 and the stream is already Opus, returns
+        an Opus passthrough source instead of the PCM volume-scaling pipeline.
+        """
+        loop = loop or asyncio.get_event_loop()
+        requester = data['requester']
+
+        # Reuse the metadata gathered at queue time if its stream URL is still valid.
+        cached = data.get('_data')
+        if cached is not None and cached.get('url') and not _stream_url_expired(cached['url']):
+            data = cached
+        else:
+            to_run = partial(_regather, data['webpage_url'])
+            try:
+                data = await asyncio.wait_for(loop.run_in_executor(pool, to_run), timeout=30)
+            except asyncio.TimeoutError:
+                raise YTDLTimeout(f'Regathering the stream for "{data["title"]}" timed out.')
+
+        if volume == 1.0 and data.get('acodec') == 'opus':
+            return YTDLOpusSource(data['url'], data=data, requester=requester)
+
+        return cls(discord.FFmpegPCMAudio(data['url'], **ffmpegopts), data=data, requester=requester)
+
+
+class YTDLOpusSource(discord.FFmpegOpusAudio):
+    """Opus passthrough variant of YTDLSource for when no volume scaling is needed.
+
+    Copies the already-Opus stream straight to Discord, skipping the
+    decode-to-PCM, scale and re-encode pipeline entirely.
+    """
+
+    def __init__(self, url, *, data, requester):
+        # discord.py turns codec='opus' into '-acodec copy'.
+        super().__init__(url, codec='opus', **ffmpegopts)
+        self.requester = requester
+
+        self.title = data.get('title')
+        self.web_url = data.get('webpage_url')
+
+
+def _discard_prefetch(task):
+    """Dispose of a prefetch task whose source will never be played.
+
+    regather_stream spawns ffmpeg inside the task, so by the time a prefetch
+    is discarded it has usually already finished and cancel() is a no-op; the
+    constructed source must be cleaned up or its ffmpeg process leaks. The
+    done-callback also consumes a failed prefetch's exception so it isn't
+    reported as never retrieved.
+    """
+    def _cleanup(t):
+        if t.cancelled():
+            return
+        if t.exception() is None:
+            t.result().cleanup()
+
+    task.cancel()
+    task.add_done_callback(_cleanup)
+
+
+class MusicPlayer(commands.Cog):
+    """A class which is assigned to each guild using the bot for Music.
+    This class implements a queue and loop, which allows for different guilds to listen to different playlists
+    simultaneously.
+    When the bot disconnects from the Voice it's instance will be destroyed.
+    """
+
+    __slots__ = ('bot', '_guild', '_channel', '_cog', 'queue', 'next', 'current', 'np', 'volume', '_prefetch',
+                 '_task')
+
+    def __init__(self, ctx):
+        self.bot = ctx.bot
+        self._guild = ctx.guild
+        self._channel = ctx.channel
+        self._cog = ctx.cog
+
+        self.queue = asyncio.Queue(maxsize=100)
+        self.next = asyncio.Event()
+
+        self.np = None  # Now playing message
+        self.volume = .5
+        self.current = None
+        self._prefetch = None  # (queued entry, Task) regathering the next track's stream
+
+        self._task = ctx.bot.loop.create_task(self.player_loop())
+
+    async def player_loop(self):
+        """Our main player loop."""
+        await self.bot.wait_until_ready()
+
+        while not self.bot.is_closed():
+            self.next.clear()
+
+            try:
+                # Wait for the next song. If we timeout cancel the player and disconnect...
+                async with timeout(300):  # 5 minutes...
+                    source = await self.queue.get()
+            except asyncio.TimeoutError:
+                return self.destroy(self._guild)
+
+            if not isinstance(source, YTDLSource):
+                # Source was probably a stream (not downloaded)
+                # So we should regather to prevent stream expiration
+                prefetch, self._prefetch = self._prefetch, None
+                try:
+                    if prefetch is not None and prefetch[0] is source:
+                        # The stream was already regathered while the last track played.
+                        source = await prefetch[1]
+                        if isinstance(source, YTDLOpusSource) and self.volume != 1.0:
+                            # Volume moved off 1.0 after the prefetch started; the
+                            # passthrough source can't scale, so rebuild as PCM.
+                            # Cheap: the stashed metadata makes this network-free.
+                            source.cleanup()
+                            source = await YTDLSource.regather_stream(prefetch[0], loop=self.bot.loop,
+                                                                      pool=self._cog._ytdl_pool,
+                                                                      volume=self.volume)
+                    else:
+                        if prefetch is not None:
+                            _discard_prefetch(prefetch[1])
+                        source = await YTDLSource.regather_stream(source, loop=self.bot.loop,
+                                                                  pool=self._cog._ytdl_pool, volume=self.volume)
+                except Exception as e:
+                    await self._channel.send(embed=_static_msg('Please make sure you are in a valid channel or provide me with one!'))
+                    continue
+
+            if isinstance(source, discord.PCMVolumeTransformer):
+                source.volume = self.volume
+            self.current = source
+
+            self._guild.voice_client.play(source, after=self._on_track_end)
+            np_embed = _msg(f'**Now Playing:** `{source.title}` requested by `{source.requester}`')
+            # Edit the previous announcement in place rather than delete + send:
+            # one REST call per track boundary instead of two.
+            if self.np is not None:
+                try:
+                    await self.np.edit(embed=np_embed)
+                except discord.HTTPException:
+                    self.np = await self._channel.send(embed=np_embed)
+            else:
+                self.np = await self._channel.send(embed=np_embed)
+
+            # Resolve the next track's stream while this one plays, so the
+            # handoff at the track boundary doesn't wait on youtube-dl.
+            upcoming = self.peek(1)
+            if upcoming and not isinstance(upcoming[0], YTDLSource):
+                head = upcoming[0]
+                self._prefetch = (head, self.bot.loop.create_task(
+                    YTDLSource.regather_stream(head, loop=self.bot.loop, pool=self._cog._ytdl_pool,
+                                               volume=self.volume)))
+
+            await self.next.wait()
+
+            # Make sure the FFmpeg process is cleaned up.
+            source.cleanup()
+            self.current = None
+            # Drop the local binding too: it would otherwise pin the finished
+            # track's source through the next (up to 5 minute) queue.get() wait.
+            del source
+
+    def _on_track_end(self, error):
+        """Callback for voice_client.play; runs in the player thread.
+
+        The old per-track lambda silently discarded the ffmpeg error argument.
+        """
+        if error:
+            log.error('Player error in guild %s: %s', self._guild.id, error)
+        self.bot.loop.call_soon_threadsafe(self.next.set)
+
+    def peek(self, n=5):
+        """Return up to the next ``n`` queued entries without removing them.
+
+        Keeps the poke at asyncio.Queue's private deque confined to one place.
+        """
+        return list(itertools.islice(self.queue._queue, 0, n))
+
+    def destroy_player(self):
+        """Cancel the player loop and drop everything it still holds."""
+        self._task.cancel()
+        if self._prefetch is not None:
+            _discard_prefetch(self._prefetch[1])
+            self._prefetch = None
+        self.queue._queue.clear()
+
+    def destroy(self, guild):
+        """Disconnect and cleanup the player."""
+        return self.bot.loop.create_task(self._cog.cleanup(guild))
+
+
+class Music(commands.Cog):
+    """Music related commands."""
+
+    __slots__ = ('bot', 'players', '_ytdl_pool')
+
+    def __init__(self, bot):
+        self.bot = bot
+        # Weak values: a player whose loop has finished (e.g. idle timeout)
+        # can be collected even if cleanup never ran for its guild.
+        self.players = WeakValueDictionary()
+        # Dedicated pool for youtube-dl so its blocking work can't tie up the
+        # loop's default executor (shared with heartbeats and other libraries).
+        self._ytdl_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='ytdl')
+
+    def cog_unload(self):
+        self._ytdl_pool.shutdown(wait=False)
+
+    async def cleanup(self, guild):
+        try:
+            await guild.voice_client.disconnect()
+        except AttributeError:
+            pass
+
+        try:
+            player = self.players.pop(guild.id)
+        except KeyError:
+            pass
+        else:
+            player.destroy_player()
+
+    async def __local_check(self, ctx):
+        """A local check which applies to all commands in this cog."""
+        if not ctx.guild:
+            raise commands.NoPrivateMessage
+        return True
+
+    async def __error(self, ctx, error):
+        """A local error handler for all errors arising from commands in this cog."""
+        if isinstance(error, commands.NoPrivateMessage):
+            try:
+                return await ctx.send('This command can not be used in Private Messages.')
+            except discord.HTTPException:
+                pass
+        elif isinstance(error, InvalidVoiceChannel):
+            return await ctx.send(embed=_static_msg('Please make sure you are in a valid channel or provide me with one'))
+        elif isinstance(error, YTDLTimeout):
+            return await ctx.send(embed=_static_msg('YouTube took too long to respond. Please try again.'))
+
+        print('Ignoring exception in command {}:'.format(ctx.command), file=sys.stderr)
+        traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+
+    def get_player(self, ctx):
+        """Retrieve the guild player, or generate one."""
+        try:
+            player = self.players[ctx.guild.id]
+        except KeyError:
+            player = MusicPlayer(ctx)
+            self.players[ctx.guild.id] = player
+
+        return player
+
+    @commands.command(name='connect', aliases=['join'])
+    async def connect_(self, ctx):
+        try:
+            channel = ctx.author.voice.channel
+        except AttributeError:
+            await ctx.send(embed=_static_msg('No channel to join.'))
+            raise InvalidVoiceChannel('No channel to join.')
+
+        vc = ctx.voice_client
+
+        if vc:
+            if vc.channel.id == channel.id:
+                return
+            try:
+                await vc.move_to(channel)
+            except asyncio.TimeoutError:
+                await ctx.send(embed=_msg(f'Moving to channel: <{channel}> timed out.'))
+                raise VoiceConnectionError(f'Moving to channel: <{channel}> timed out.')
+        else:
+            try:
+                await channel.connect()
+            except asyncio.TimeoutError:
+                await ctx.send(embed=_msg(f'Connecting to channel: <{channel}> timed out.'))
+                raise VoiceConnectionError(f'Connecting to channel: <{channel}> timed out.')
+
+        await ctx.send(embed=_msg(f':white_check_mark: Connected to: **{channel}** :white_check_mark:'))
+
+    @commands.command(name='play', aliases=['sing'])
+    async def play_(self, ctx, *, search: str):
+        await ctx.trigger_typing()
+
+        vc = ctx.voice_client
+
+        if not vc:
+            await ctx.invoke(self.connect_)
+
+        player = self.get_player(ctx)
+
+        # Refuse up front: create_source announces the track, so extracting
+        # first would send a contradictory "Added" before the full-queue reply.
+        if player.queue.full():
+            return await ctx.send(embed=_static_msg('Queue is full (max 100). Try again after some songs finish.'))
+
+        # If download is False, source will be a dict which will be used later to regather the stream.
+        # If download is True, source will be a discord.FFmpegPCMAudio with a VolumeTransformer.
+        source = await YTDLSource.create_source(ctx, search, loop=self.bot.loop, pool=self._ytdl_pool,
+                                                download=False)
+
+        try:
+            player.queue.put_nowait(source)
+        except asyncio.QueueFull:
+            await ctx.send(embed=_static_msg('Queue is full (max 100). Try again after some songs finish.'))
+
+    @commands.command(name='playall', aliases=['pa'])
+    async def playall_(self, ctx, *, search: str):
+        """Queue every track of a playlist, not just the first one."""
+        await ctx.trigger_typing()
+
+        vc = ctx.voice_client
+
+        if not vc:
+            await ctx.invoke(self.connect_)
+
+        player = self.get_player(ctx)
+
+        if player.queue.full():
+            return await ctx.send(embed=_static_msg('Queue is full (max 100). Try again after some songs finish.'))
+
+        sources, unavailable = await YTDLSource.create_playlist_sources(ctx, search, loop=self.bot.loop,
+                                                                        pool=self._ytdl_pool)
+
+        queued = 0
+        for source in sources:
+            try:
+                player.queue.put_nowait(source)
+                queued += 1
+            except asyncio.QueueFull:
+                break
+
+        # One summary with the real numbers, sent only after enqueueing.
+        notes = []
+        if unavailable:
+            notes.append(f'{unavailable} unavailable')
+        if queued < len(sources):
+            notes.append(f'{len(sources) - queued} dropped, queue full')
+        summary = f'[Added {queued} songs to the Queue'
+        if notes:
+            summary += f' ({", ".join(notes)})'
+        summary += '.]'
+        await ctx.send(embed=_msg(f'```ini\n{summary}\n```'))
+
+    @commands.command(name='pause')
+    async def pause_(self, ctx):
+        """Pause the currently playing song."""
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_playing():
+            return await ctx.send(embed=_static_msg('I am not currently playing anything!'))
+        elif vc.is_paused():
+            return
+
+        vc.pause()
+        await ctx.send(embed=_msg(f'**`{ctx.author}`**: Paused the song!'))
+
+    @commands.command(name='resume')
+    async def resume_(self, ctx):
+        """Resume the currently paused song."""
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_connected():
+            return await ctx.send(embed=_static_msg('I am not currently playing anything!'))
+        elif not vc.is_paused():
+            return
+
+        vc.resume()
+        await ctx.send(embed=_msg(f'**`{ctx.author}`**: Resumed the song!'))
+
+    @commands.command(name='skip')
+    async def skip_(self, ctx):
+        """Skip the song."""
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_connected():
+            return await ctx.send(embed=_static_msg('I am not currently playing anything!'))
+
+        if vc.is_paused():
+            pass
+        elif not vc.is_playing():
+            return
+
+        vc.stop()
+        await ctx.send(embed=_msg(f'**`{ctx.author}`**: Skipped the song!'))
+
+    @commands.command(name='clear')
+    @commands.has_permissions(manage_guild=True)
+    async def clear_(self, ctx):
+        """Remove all queued songs without stopping the current one."""
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_connected():
+            return await ctx.send(embed=_static_msg('I am not currently connected to voice!'))
+
+        player = self.get_player(ctx)
+        player.queue._queue.clear()
+        await ctx.send(embed=_msg(f'**`{ctx.author}`**: Cleared the queue!'))
+
+    @commands.command(name='queue', aliases=['q', 'playlist'])
+    async def queue_info(self, ctx):
+        """Retrieve a basic queue of upcoming songs."""
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_connected():
+            return await ctx.send(embed=_static_msg('I am not currently connected to voice!'))
+
+        player = self.get_player(ctx)
+        if player.queue.empty():
+            return await ctx.send(embed=_static_msg('There are currently no more queued songs.'))
+
+        # Grab up to 5 entries from the queue...
+        upcoming = player.peek(5)
+        n = len(upcoming)
+
+        titles = [entry['title'] for entry in upcoming]
+        fmt = '\n'.join(f'**`{title}`**' for title in titles)
+        embed = discord.Embed(title=f'Upcoming - Next {n}', description=fmt)
+
+        await ctx.send(embed=embed)
+
+    @commands.command(name='now_playing', aliases=['np', 'current', 'currentsong', 'playing'])
+    async def now_playing_(self, ctx):
+        """Display information about the currently playing song."""
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_connected():
+            return await ctx.send(embed=_static_msg('I am not currently connected to voice!'))
+
+        player = self.get_player(ctx)
+        if not player.current:
+            return await ctx.send(embed=_static_msg('I am not currently playing anything!'))
+
+        np_embed = _msg(f'**Now Playing:** `{vc.source.title}` requested by `{vc.source.requester}`')
+
+        if player.np is not None and player.np.channel == ctx.channel:
+            try:
+                # Refresh the existing announcement in place.
+                return await player.np.edit(embed=np_embed)
+            except discord.HTTPException:
+                pass
+        else:
+            try:
+                # Remove our previous now_playing message before moving channels.
+                await player.np.delete()
+            except (AttributeError, discord.HTTPException):
+                pass
+
+        player.np = await ctx.send(embed=np_embed)
+
+    @commands.command(name='volume', aliases=['vol'])
+    async def change_volume(self, ctx, *, vol: float):
+        """Change the player volume.
+        Parameters
+        ------------
+        volume: float or int [Required]
+            The volume to set the player to in percentage. This must be between 1 and 100.
+        """
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_connected():
+            return await ctx.send(embed=_static_msg("I am not currently connected to voice!"))
+
+        if not 0 < vol < 101:
+            return await ctx.send(embed=_static_msg("Please enter a value between 1 and 100."))
+
+        player = self.get_player(ctx)
+
+        # An Opus passthrough source has no volume control; the new volume
+        # takes effect from the next track instead.
+        if vc.source and isinstance(vc.source, discord.PCMVolumeTransformer):
+            vc.source.volume = vol / 100
+
+        player.volume = vol / 100
+        await ctx.send(embed=_msg(f'**`{ctx.author}`**: Set the volume to **{vol}%**'))
+
+    @commands.command(name='stop', aliases=['leave'])
+    async def stop_(self, ctx):
+        """Stop the currently playing song and destroy the player.
+        !Warning!
+            This will destroy the player assigned to your guild, also deleting any queued songs and settings.
+        """
+        vc = ctx.voice_client
+
+        if not vc or not vc.is_connected():
+            return await ctx.send(embed=_static_msg("I am not currently playing anything!"))
+
+        await self.cleanup(ctx.guild)
+
+    @commands.command()
+    async def server_info(self, ctx):
+        name = str(ctx.guild.name)
+        description = str(ctx.guild.description)
+
+        owner = str(ctx.guild.owner)
+        id = str(ctx.guild.id)
+        region = str(ctx.guild.region)
+        memberCount = str(ctx.guild.member_count)
+
+        icon = str(ctx.guild.icon_url)
+
+        embed = discord.Embed(
+            title=name + " Server Information",
+            description=description,
+            color=discord.Color.blue()
+        )
+        embed.set_thumbnail(url=icon)
+        embed.add_field(name="Owner", value=owner, inline=True)
+        embed.add_field(name="Server ID", value=id, inline=True)
+        embed.add_field(name="Region", value=region, inline=True)
+        embed.add_field(name="Member Count", value=memberCount, inline=True)
+
+        await ctx.send(embed=embed)
+
+def setup(bot):
     bot.add_cog(Music(bot))
\ No newline at end of file